@@ -0,0 +1,350 @@
+"""
+Alerting on the stream of parsed updates.
+
+Rules watch a single field, given by its node name as in the
+_default_*_fields dicts of logwatcher (e.g. "cpaerr", "t6_mc", "p1").
+The engine indexes the rules by the id of the field they watch, so that
+processing a batch of updates only evaluates the rules referencing one of
+the updated ids. Stale-value rules are kept in a heap ordered by deadline,
+so checking for stale values only touches the rules that actually expired.
+
+As the parsers only report changed values, a stale-value rule is reset by
+any line of the log file of its field (its source, see
+logwatcher.field_source()), not only by updates of the field; the updates
+name their source, see AlertEngine.process(). Fields without a source,
+e.g. derived channels, are stale when they are not updated. Staleness is
+measured with the clock of the engine (by default the wall clock), as the
+times of the log lines only advance while lines arrive.
+
+Whenever a rule changes state, an alert is handed to all hooks of the
+engine. An alert is a dict:
+
+    {"rule": name, "field": id, "state": "raised" or "cleared",
+     "value": last value, "time": unix time, "message": text}
+
+Example rule configuration (JSON):
+
+    {
+        "prefix": "bluefors/",
+        "rules": [
+            {"name": "compressor error", "type": "threshold",
+             "field": "cpaerr", "above": 0},
+            {"name": "MC warming", "type": "rate", "field": "t6_mc",
+             "window": 600, "max_rate": 1e-5, "hysteresis": 2e-6},
+            {"name": "P1 high", "type": "threshold", "field": "p1",
+             "above": 1e-3, "hysteresis": 2e-4},
+            {"name": "MC thermometer stale", "type": "stale",
+             "field": "t6_mc", "timeout": 300}
+        ]
+    }
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import subprocess
+import time
+
+import logwatcher
+
+
+class Rule(object):
+    """Base class of all rules.
+
+    Subclasses implement check(value, now), returning whether the alert
+    condition holds after the field was updated with value.
+    """
+
+    def __init__(self, name, field, message=None):
+        self.name = name
+        self.field = field
+        self.message = message
+        self.active = False
+
+    def check(self, value, now):
+        raise NotImplementedError
+
+    def describe(self, value):
+        if self.message is not None:
+            return self.message
+        return "{}: {} = {}".format(self.name, self.field, value)
+
+
+class ThresholdRule(Rule):
+    """Raised when the value is above `above` or below `below`.
+
+    Once raised, the alert is only cleared when the value is back inside
+    the allowed range by more than `hysteresis`.
+    """
+
+    def __init__(self, name, field, above=None, below=None, hysteresis=0,
+                 message=None):
+        super().__init__(name, field, message)
+        if above is None and below is None:
+            raise ValueError(
+                "threshold rule {} needs 'above' or 'below'".format(name))
+        self.above = above
+        self.below = below
+        self.hysteresis = hysteresis
+
+    def check(self, value, now):
+        value = _as_float(value)
+        if value is None:
+            return self.active
+        margin = self.hysteresis if self.active else 0
+        if self.above is not None and value > self.above - margin:
+            return True
+        if self.below is not None and value < self.below + margin:
+            return True
+        return False
+
+
+class RateRule(Rule):
+    """Raised when the value changes faster than `max_rate` (per second),
+    measured over the last `window` seconds.
+
+    Once raised, the alert is only cleared when the rate drops below
+    `max_rate - hysteresis`.
+    """
+
+    def __init__(self, name, field, window, max_rate, hysteresis=0,
+                 message=None):
+        super().__init__(name, field, message)
+        self.window = window
+        self.max_rate = max_rate
+        self.hysteresis = hysteresis
+        self.samples = collections.deque()
+
+    def check(self, value, now):
+        value = _as_float(value)
+        if value is None:
+            return self.active
+        samples = self.samples
+        if samples and now <= samples[-1][0]:
+            # not a new sample
+            return self.active
+        samples.append((now, value))
+        while now - samples[0][0] > self.window:
+            samples.popleft()
+        t0, v0 = samples[0]
+        if now <= t0:
+            return self.active
+        rate = abs(value - v0) / (now - t0)
+        margin = self.hysteresis if self.active else 0
+        return rate > self.max_rate - margin
+
+
+class StaleRule(Rule):
+    """Raised when no line of the source of the field (or, without
+    source, no update of the field) arrived for `timeout` seconds.
+    Cleared by the next one. Evaluated by the engine, not by check().
+    """
+
+    def __init__(self, name, field, timeout, message=None):
+        super().__init__(name, field, message)
+        self.timeout = timeout
+        self.source = logwatcher.field_source(field)
+        self.last_seen = None
+        self.scheduled = False
+
+    def describe(self, value):
+        if self.message is not None or not self.active:
+            return super().describe(value)
+        return "{}: no update of {} for {} s".format(
+            self.name, self.field, self.timeout)
+
+
+rule_types = {
+    "threshold": ThresholdRule,
+    "rate": RateRule,
+    "stale": StaleRule,
+}
+
+
+class AlertEngine(object):
+    """Evaluates rules against batches of updates.
+
+    Example:
+
+    >>> engine = AlertEngine([ThresholdRule("err", "cpaerr", above=0)],
+    ...                      hooks=[print_hook])
+    >>> engine.process({"cpaerr": ("Compressor 1 Error", None, 3)},
+    ...                sources=["Status"])
+    """
+
+    def __init__(self, rules=(), hooks=(), prefix="", clock=time.time):
+        """Arguments:
+
+        (list) @rules:
+            rules to add to the engine
+
+        (list) @hooks:
+            callables which are called with every alert emitted
+
+        (str) @prefix:
+            prefix of the update ids, as the prefix of the parsers
+            (e.g. "bluefors/")
+
+        (callable) @clock:
+            returns the current time for the stale-value rules
+        """
+        self.prefix = prefix
+        self.hooks = list(hooks)
+        self.clock = clock
+        self.rules = collections.OrderedDict()
+        self.rules_by_id = collections.defaultdict(list)
+        self.stale_by_source = collections.defaultdict(list)
+        self._stale = []
+        self._counter = itertools.count()
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        if rule.name in self.rules:
+            raise ValueError("duplicate rule name {}".format(rule.name))
+        self.rules[rule.name] = rule
+        if isinstance(rule, StaleRule):
+            if rule.source is not None:
+                self.stale_by_source[rule.source].append(rule)
+            else:
+                self.rules_by_id[self.prefix + rule.field].append(rule)
+            # fields never seen are stale `timeout` seconds after startup
+            rule.last_seen = self.clock()
+            self._schedule(rule)
+        else:
+            self.rules_by_id[self.prefix + rule.field].append(rule)
+
+    def _schedule(self, rule):
+        heapq.heappush(self._stale, (rule.last_seen + rule.timeout,
+                                     next(self._counter), rule))
+        rule.scheduled = True
+
+    def process(self, updates, now=None, times=None, sources=()):
+        """Evaluate the rules referencing the ids in updates, a dict
+        mapping ids to values, and reset the stale-value rules of the
+        sources from which lines arrived. Return the list of alerts emitted.
+
+        The time of each update is taken from times, a dict mapping ids to
+        timestamps, or is now.
+        """
+        if now is None:
+            now = time.time()
+        if times is None:
+            times = {}
+        alerts = []
+        for source in sources:
+            for rule in self.stale_by_source.get(source, ()):
+                self._seen(rule, alerts)
+        for id, value in updates.items():
+            rules = self.rules_by_id.get(id)
+            if not rules:
+                continue
+            value = logwatcher.field_value(value)
+            t = times.get(id, now)
+            for rule in rules:
+                if isinstance(rule, StaleRule):
+                    self._seen(rule, alerts)
+                    continue
+                state = rule.check(value, t)
+                if state != rule.active:
+                    alerts.append(self._transition(rule, state, value, t))
+        self._emit(alerts)
+        return alerts
+
+    def _seen(self, rule, alerts):
+        rule.last_seen = self.clock()
+        if rule.active:
+            alerts.append(
+                self._transition(rule, False, None, rule.last_seen))
+        if not rule.scheduled:
+            self._schedule(rule)
+
+    def check_stale(self):
+        """Raise the stale-value rules whose deadline has passed.
+        This should be called periodically.
+        """
+        now = self.clock()
+        alerts = []
+        while self._stale and self._stale[0][0] <= now:
+            _, _, rule = heapq.heappop(self._stale)
+            rule.scheduled = False
+            if rule.last_seen + rule.timeout > now:
+                # updated in the meantime
+                self._schedule(rule)
+            elif not rule.active:
+                alerts.append(self._transition(rule, True, None, now))
+        self._emit(alerts)
+        return alerts
+
+    def active_alerts(self):
+        return [r.name for r in self.rules.values() if r.active]
+
+    def _transition(self, rule, state, value, now):
+        rule.active = state
+        return {
+            "rule": rule.name,
+            "field": self.prefix + rule.field,
+            "state": "raised" if state else "cleared",
+            "value": value,
+            "time": now,
+            "message": rule.describe(value),
+        }
+
+    def _emit(self, alerts):
+        for alert in alerts:
+            for hook in self.hooks:
+                hook(alert)
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_rules(config, known_fields=None):
+    """Create rules from a list of dicts, as in the "rules" entry of the
+    configuration file. Raise ValueError for unknown rule types, fields or
+    options.
+    """
+    if known_fields is None:
+        known_fields = logwatcher.field_names()
+    rules = []
+    for entry in config:
+        entry = dict(entry)
+        kind = entry.pop("type", "threshold")
+        if kind not in rule_types:
+            raise ValueError("unknown rule type {}".format(kind))
+        if entry.get("field") not in known_fields:
+            raise ValueError("rule {} references unknown field {}".format(
+                entry.get("name"), entry.get("field")))
+        try:
+            rules.append(rule_types[kind](**entry))
+        except TypeError as err:
+            raise ValueError("invalid options for rule {}: {}".format(
+                entry.get("name"), err))
+    return rules
+
+
+def engine_from_file(fname, hooks=(), known_fields=None):
+    """Create an AlertEngine from a JSON configuration file."""
+    with open(fname) as f:
+        config = json.load(f)
+    rules = load_rules(config["rules"], known_fields)
+    return AlertEngine(rules, hooks, config.get("prefix", ""))
+
+
+def print_hook(alert):
+    print("ALERT [{}] {}".format(alert["state"], alert["message"]))
+
+
+def command_hook(command):
+    """Return a hook running the shell command for each alert,
+    with the alert as JSON on stdin. The command should return quickly.
+    """
+    def hook(alert):
+        p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        p.communicate(json.dumps(alert, default=str).encode())
+    return hook
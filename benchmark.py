@@ -0,0 +1,435 @@
+"""
+Benchmarks of the monitoring pipeline, on synthetic Bluefors log files.
+
+Generate a log tree, e.g. for testing the dashboard or the report:
+
+    python benchmark.py generate ./Logs --start "17-11-18 00:00" --hours 48
+
+Run the benchmarks and store the results, then compare with an earlier run:
+
+    python benchmark.py run -o new.json
+    python benchmark.py run -s parser -s watcher --compare old.json
+
+Results are JSON: {"commit": ..., "python": ..., "results":
+{scenario: {metric: value}}}. Scenarios whose dependencies are missing are
+reported as skipped, scenarios which fail with their error.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import compact_logs
+import logwatcher
+
+
+class LogGenerator(object):
+    """Writes Bluefors-style log files into day folders of folder,
+    one sample of every channel each `interval` seconds, starting at start.
+    A new day folder and new files are started at each day boundary.
+
+    The temperatures follow a cooldown from room temperature.
+    """
+
+    temp_channels = [
+        # channel, base temperature, time constant in hours
+        ("CH1", 45.0, 10.0),
+        ("CH2", 3.5, 14.0),
+        ("CH5", 0.8, 20.0),
+        ("CH6", 0.01, 22.0),
+    ]
+
+    # kind of log file and its name for a day
+    file_names = {
+        "CH1": "CH1 T {}.log",
+        "CH2": "CH2 T {}.log",
+        "CH5": "CH5 T {}.log",
+        "CH6": "CH6 T {}.log",
+        "maxigauge": "maxigauge {}.log",
+        "Flowmeter": "Flowmeter {}.log",
+        "Status": "Status_{}.log",
+        "heaters": "heaters_{}.log",
+    }
+
+    def __init__(self, folder, start, interval=10, seed=0):
+        self.folder = folder
+        self.start = start
+        self.time = start
+        self.interval = interval
+        self.random = random.Random(seed)
+        self.status_keys = sorted(logwatcher._default_status_fields)
+        self.heater_keys = sorted(logwatcher._default_heater_fields)
+
+    def sample_lines(self, t):
+        """Return a dict mapping the kinds of log files to the log line of
+        the sample at datetime t.
+        """
+        stamp = t.strftime("%d-%m-%y,%H:%M:%S")
+        hours = (t - self.start).total_seconds() / 3600
+        noise = self.random.gauss
+        lines = {}
+
+        for channel, base, tau in self.temp_channels:
+            temp = base + (300 - base) * math.exp(-hours / tau)
+            lines[channel] = "{},{:.6E}".format(
+                stamp, temp * (1 + 1e-3 * noise(0, 1)))
+
+        pressures = [1e-6, 1e-2, 0.5, 400, 700, 1e-1]
+        items = []
+        for n, p in enumerate(pressures):
+            items.extend([
+                "CH{}".format(n + 1), "P{}       ".format(n + 1), "1",
+                "{:.2E}".format(p * (1 + 1e-2 * noise(0, 1))), "0", "1"])
+        lines["maxigauge"] = ",".join([stamp] + items)
+
+        lines["Flowmeter"] = "{},{:.6E}".format(
+            stamp, 0.6 + 0.01 * noise(0, 1))
+
+        items = []
+        for k in self.status_keys:
+            if logwatcher._default_status_fields[k][3] is float:
+                value = 10 + noise(0, 0.1)
+            else:
+                value = 1 if k.startswith("cparun") else 0
+            items.extend([k, "{:.6E}".format(value)])
+        lines["Status"] = ",".join([stamp] + items)
+
+        items = []
+        for k in self.heater_keys:
+            value = self.random.randint(0, 8) if k == "htr_range" else \
+                abs(noise(1, 0.1))
+            items.extend([k, "{:.6E}".format(value)])
+        lines["heaters"] = ",".join([stamp] + items)
+
+        return lines
+
+    def write(self, samples):
+        """Append the next samples to the log files. Return the number of
+        lines written.
+        """
+        files = {}
+        for n in range(samples):
+            day = self.time.strftime("%y-%m-%d")
+            for kind, line in self.sample_lines(self.time).items():
+                fname = self.file_names[kind].format(day)
+                files.setdefault((day, fname), []).append(line + "\n")
+            self.time += datetime.timedelta(seconds=self.interval)
+
+        for (day, fname), lines in files.items():
+            path = os.path.join(self.folder, day)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, fname), "a") as f:
+                f.write("".join(lines))
+        return sum(len(lines) for lines in files.values())
+
+
+def default_parsers():
+    """Return a dict mapping the kinds of log files to their parsers."""
+    return {
+        "CH1": logwatcher.FieldsParser(
+            "bluefors/", ".*CH1 T", logwatcher._default_temp_fields_CH1),
+        "CH2": logwatcher.FieldsParser(
+            "bluefors/", ".*CH2 T", logwatcher._default_temp_fields_CH2),
+        "CH5": logwatcher.FieldsParser(
+            "bluefors/", ".*CH5 T", logwatcher._default_temp_fields_CH5),
+        "CH6": logwatcher.FieldsParser(
+            "bluefors/", ".*CH6 T", logwatcher._default_temp_fields_CH6),
+        "maxigauge": logwatcher.FieldsParser(
+            "bluefors/", ".*maxigauge", logwatcher._default_pressure_fields),
+        "Flowmeter": logwatcher.FieldsParser(
+            "bluefors/", ".*Flowmeter", logwatcher._default_flowmeter_fields),
+        "heaters": logwatcher.StatusParser(
+            "bluefors/", ".*heaters", logwatcher._default_heater_fields),
+        "Status": logwatcher.StatusParser(
+            "bluefors/", ".*Status", logwatcher._default_status_fields),
+    }
+
+
+def _generated_lines(samples):
+    """Return a dict mapping the kinds of log files to lists of lines."""
+    gen = LogGenerator(None, datetime.datetime(2017, 11, 18), 10)
+    files = {}
+    for n in range(samples):
+        for kind, line in gen.sample_lines(gen.time).items():
+            files.setdefault(kind, []).append(line)
+        gen.time += datetime.timedelta(seconds=gen.interval)
+    return files
+
+
+def bench_parser(samples=5000):
+    """Lines per second of each parser."""
+    lines = _generated_lines(samples)
+    results = {}
+    for kind, p in default_parsers().items():
+        t0 = time.perf_counter()
+        for line in lines[kind]:
+            p.parse_line(line)
+        elapsed = time.perf_counter() - t0
+        results[kind + "_lines_per_s"] = len(lines[kind]) / elapsed
+    return results
+
+
+class _QuietLogWatcher(logwatcher.LogWatcher):
+    def log(self, line):
+        pass
+
+
+def bench_watcher(samples=20000, batch=500):
+    """Lines per second read by LogWatcher while the files are appended
+    to, including a rotation at midnight.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        start = datetime.datetime(2017, 11, 18, 23)
+        gen = LogGenerator(folder, start, interval=1)
+        gen.write(1)
+        lines = [0]
+
+        def callback(filename, new_lines):
+            lines[0] += len(new_lines)
+
+        lw = _QuietLogWatcher(folder, callback)
+        elapsed = 0
+        written = 0
+        while written < samples:
+            gen.write(batch)
+            written += batch
+            t0 = time.perf_counter()
+            lw.loop(0, blocking=False)
+            elapsed += time.perf_counter() - t0
+        lw.close()
+    return {
+        "lines": lines[0],
+        "lines_per_s": lines[0] / elapsed,
+    }
+
+
+def bench_history(hours=24, suffix=None):
+    """Lines per second of parsing day folders with read_history,
+    optionally compressed with suffix (".gz" or ".xz").
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        start = datetime.datetime(2017, 11, 18)
+        gen = LogGenerator(folder, start, interval=10)
+        lines = gen.write(int(hours * 3600 / 10))
+        if suffix is not None:
+            compact_logs.compact(folder, suffix, keep_days=0)
+        files = logwatcher.history_files(folder, start)
+        size = sum(os.path.getsize(f) for f in files)
+        t0 = time.perf_counter()
+        logwatcher.read_history(
+            folder, list(default_parsers().values()), start)
+        elapsed = time.perf_counter() - t0
+    return {
+        "lines": lines,
+        "bytes": size,
+        "lines_per_s": lines / elapsed,
+    }
+
+
+def _update_messages(samples):
+    """Update messages as sent by the log watcher, one per sample."""
+    parsers = default_parsers()
+    lines = _generated_lines(samples)
+    messages = []
+    for n in range(samples):
+        message = []
+        for kind, p in parsers.items():
+            updates = p.parse_line(lines[kind][n])
+            timestamp = p.last_values['time'].timestamp()
+            message.extend({'id': k, 'value': v, 'timestamp': timestamp}
+                           for k, v in updates.items())
+        messages.append(json.dumps(message, default=str))
+    return messages
+
+
+def bench_publisher(samples=500):
+    """Updates per second handled by the /update path of the server."""
+    import server
+
+    messages = _update_messages(samples)
+    client = server.app.test_client()
+    updates = sum(len(json.loads(m)) for m in messages)
+    t0 = time.perf_counter()
+    for m in messages:
+        client.post("/update", data=m)
+    elapsed = time.perf_counter() - t0
+    return {
+        "requests_per_s": samples / elapsed,
+        "updates_per_s": updates / elapsed,
+    }
+
+
+def bench_fanout(clients=100, messages=1000):
+    """Messages per second delivered to N subscribers, each reading its
+    stream of /subscribe in a greenlet, and the latency from publishing a
+    message to its delivery.
+    """
+    import gevent
+    import server
+
+    msg = _update_messages(1)[0]
+    published = []
+    latencies = []
+
+    def consume(stream):
+        # messages arrive in order, so the n-th one is published[n]
+        for n, m in enumerate(stream):
+            latencies.append(time.perf_counter() - published[n])
+            if n + 1 == messages:
+                return
+
+    streams = [server.subscribe().response for n in range(clients)]
+    consumers = [gevent.spawn(consume, s) for s in streams]
+    try:
+        # let all consumers subscribe and wait for messages
+        gevent.idle()
+        t0 = time.perf_counter()
+        for n in range(messages):
+            published.append(time.perf_counter())
+            server.publish(msg)
+            # deliver to all subscribers before publishing the next one
+            gevent.idle()
+        gevent.joinall(consumers)
+        elapsed = time.perf_counter() - t0
+    finally:
+        gevent.killall(consumers)
+        for s in streams:
+            # unsubscribes
+            s.close()
+    latencies.sort()
+    return {
+        "clients": clients,
+        "delivered": len(latencies),
+        "messages_per_s": messages / elapsed,
+        "deliveries_per_s": len(latencies) / elapsed,
+        "latency_mean_s": sum(latencies) / len(latencies),
+        "latency_p99_s": latencies[int(0.99 * (len(latencies) - 1))],
+    }
+
+
+def bench_report(hours=72):
+    """Time to generate the report of fridge_tracker."""
+    import fridge_tracker
+
+    with tempfile.TemporaryDirectory() as folder:
+        start = datetime.datetime(2017, 11, 18)
+        gen = LogGenerator(folder, start, interval=10)
+        gen.write(int(hours * 3600 / 10))
+        t0 = time.perf_counter()
+        fridge_tracker.make_report(
+            folder + "/", start.strftime("%y-%m-%d"),
+            os.path.join(folder, "index.html"))
+        elapsed = time.perf_counter() - t0
+    return {
+        "hours": hours,
+        "seconds": elapsed,
+    }
+
+
+scenarios = {
+    "parser": bench_parser,
+    "watcher": bench_watcher,
+    "history": bench_history,
+    "history_gz": lambda: bench_history(suffix=".gz"),
+    "history_xz": lambda: bench_history(suffix=".xz"),
+    "publisher": bench_publisher,
+    "fanout": bench_fanout,
+    "report": bench_report,
+}
+
+
+def run(names):
+    results = {}
+    for name in names:
+        print("running {}...".format(name), file=sys.stderr)
+        try:
+            results[name] = scenarios[name]()
+        except ImportError as err:
+            results[name] = {"skipped": str(err)}
+        except Exception as err:
+            results[name] = {"error": "{}: {}".format(
+                type(err).__name__, err)}
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Print the metrics of two runs side by side."""
+    print("{:40} {:>14} {:>14} {:>8}".format(
+        "metric", str(old["commit"])[:8], str(new["commit"])[:8], "ratio"))
+    for name, metrics in new["results"].items():
+        old_metrics = old["results"].get(name, {})
+        for k, v in metrics.items():
+            o = old_metrics.get(k)
+            if not isinstance(v, (int, float)) or \
+                    not isinstance(o, (int, float)):
+                continue
+            ratio = v / o if o else float("nan")
+            print("{:40} {:>14.4g} {:>14.4g} {:>8.3f}".format(
+                name + "." + k, o, v, ratio))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    commands = argparser.add_subparsers(dest="command")
+
+    gen_parser = commands.add_parser(
+        "generate", help="write synthetic log files")
+    gen_parser.add_argument("folder")
+    gen_parser.add_argument(
+        "--start", default=None,
+        help='start time as "yy-mm-dd HH:MM" (default: now)')
+    gen_parser.add_argument("--hours", type=float, default=24)
+    gen_parser.add_argument(
+        "--interval", type=float, default=10,
+        help="seconds between samples")
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument(
+        "-s", "--scenario", action="append", choices=sorted(scenarios),
+        help="scenario to run (default: all)")
+    run_parser.add_argument("-o", "--output", help="write results to file")
+    run_parser.add_argument("--compare", help="results file to compare to")
+
+    args = argparser.parse_args()
+
+    if args.command == "generate":
+        if args.start is None:
+            start = datetime.datetime.now().replace(microsecond=0)
+        else:
+            start = datetime.datetime.strptime(args.start, "%y-%m-%d %H:%M")
+        gen = LogGenerator(args.folder, start, args.interval)
+        lines = gen.write(int(args.hours * 3600 / args.interval))
+        print("wrote {} lines".format(lines))
+    elif args.command == "run":
+        results = run(args.scenario or sorted(scenarios))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), results)
+        else:
+            print(json.dumps(results, indent=2))
+    else:
+        argparser.print_help()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Compress the log files of closed day folders.
+
+    python compact_logs.py ./Logs [--format xz] [--keep-days 2]
+
+The most recent `keep-days` day folders (including today) are left alone,
+as the Bluefors software may still write to them. The compressed files
+are read by the history readers of logwatcher and by fridge_tracker, and
+ignored by the live watcher.
+"""
+
+import argparse
+import datetime
+import os
+import re
+import shutil
+
+import logwatcher
+
+
+day_folder_regex = re.compile(r"\d\d-\d\d-\d\d$")
+
+
+def compress_file(fname, suffix=".gz"):
+    """Compress fname to fname + suffix and remove fname."""
+    opener = logwatcher.compressed_openers[suffix]
+    tmp = fname + suffix + ".tmp"
+    with open(fname, "rb") as src, opener(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    shutil.copystat(fname, tmp)
+    os.rename(tmp, fname + suffix)
+    os.remove(fname)
+
+
+def compact(folder, suffix=".gz", keep_days=2):
+    """Compress the log files in the day folders of folder older than
+    keep_days days. Return the list of compressed files.
+    """
+    first_kept = (datetime.date.today() -
+                  datetime.timedelta(days=keep_days - 1)).strftime("%y-%m-%d")
+    compressed = []
+    for d in sorted(os.listdir(folder)):
+        path = os.path.join(folder, d)
+        if not (day_folder_regex.match(d) and d < first_kept and
+                os.path.isdir(path)):
+            continue
+        for f in sorted(os.listdir(path)):
+            if f.endswith(".log"):
+                fname = os.path.join(path, f)
+                compress_file(fname, suffix)
+                compressed.append(fname)
+    return compressed
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("folder")
+    argparser.add_argument(
+        "--format", choices=["gz", "xz"], default="gz")
+    argparser.add_argument(
+        "--keep-days", type=int, default=2,
+        help="number of most recent day folders to leave uncompressed")
+    args = argparser.parse_args()
+
+    for fname in compact(args.folder, "." + args.format, args.keep_days):
+        print("compressed %s" % fname)
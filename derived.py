@@ -0,0 +1,241 @@
+"""
+Derived channels, computed from the raw fields of the parsers.
+
+A derived channel is defined over the ids of existing fields (raw or
+derived) and is recomputed only when one of its inputs appears in a batch
+of updates. Its value is published under its own id, in the same
+(pp_name, pp_unit, value) form as the raw fields, so it can be displayed,
+alerted on etc. like any other field.
+
+Windowed aggregates (moving average, slope) are exponentially weighted with
+a time constant, so that they keep constant state per channel and cost
+O(1) per update.
+"""
+
+import collections
+import heapq
+import math
+import time
+
+import logwatcher
+
+
+class DerivedChannel(object):
+    """A channel computed as func(*inputs) from the current values of
+    the input fields.
+    """
+
+    def __init__(self, name, inputs, func, pp_name=None, pp_unit=""):
+        self.name = name
+        self.inputs = list(inputs)
+        self.func = func
+        self.pp_name = name if pp_name is None else pp_name
+        self.pp_unit = pp_unit
+
+    def compute(self, values, now):
+        try:
+            return self.func(*[float(v) for v in values])
+        except (TypeError, ValueError, ZeroDivisionError):
+            return None
+
+
+class MovingAverage(DerivedChannel):
+    """Exponential moving average of a single input with time constant
+    tau (in seconds).
+    """
+
+    def __init__(self, name, input, tau, pp_name=None, pp_unit=""):
+        super().__init__(name, [input], None, pp_name, pp_unit)
+        self.tau = tau
+        self.last_time = None
+        self.average = None
+
+    def compute(self, values, now):
+        try:
+            value = float(values[0])
+        except (TypeError, ValueError):
+            return None
+        if self.last_time is not None and now <= self.last_time:
+            # not a new sample
+            return None
+        if self.last_time is None:
+            self.average = value
+        else:
+            a = math.exp(-(now - self.last_time) / self.tau)
+            self.average = a * self.average + (1 - a) * value
+        self.last_time = now
+        return self.average
+
+
+class Slope(DerivedChannel):
+    """Slope of a single input, from an exponentially weighted linear
+    least-squares fit with time constant tau (in seconds).
+
+    The slope is given per `per` seconds (e.g. per=3600 for a rate per
+    hour). Times are kept relative to the last sample to avoid loss of
+    precision.
+    """
+
+    def __init__(self, name, input, tau, per=1, pp_name=None, pp_unit=""):
+        super().__init__(name, [input], None, pp_name, pp_unit)
+        self.tau = tau
+        self.per = per
+        self.last_time = None
+        # weighted sums of 1, t, t^2, v, t*v
+        self.s0 = self.st = self.stt = self.sv = self.stv = 0.0
+
+    def compute(self, values, now):
+        try:
+            value = float(values[0])
+        except (TypeError, ValueError):
+            return None
+        if self.last_time is not None and now <= self.last_time:
+            # not a new sample
+            return None
+        if self.last_time is not None:
+            d = now - self.last_time
+            a = math.exp(-d / self.tau)
+            # shift the time origin to now, then decay
+            self.stt = a * (self.stt - 2 * d * self.st + d * d * self.s0)
+            self.stv = a * (self.stv - d * self.sv)
+            self.st = a * (self.st - d * self.s0)
+            self.s0 = a * self.s0
+            self.sv = a * self.sv
+        self.last_time = now
+        self.s0 += 1
+        self.sv += value
+
+        det = self.s0 * self.stt - self.st * self.st
+        if det <= 1e-12 * self.s0 * self.stt:
+            return None
+        return (self.s0 * self.stv - self.st * self.sv) / det * self.per
+
+
+class DerivedEngine(object):
+    """Keeps the current values of the inputs and recomputes the derived
+    channels affected by a batch of updates.
+
+    Channels may use other derived channels as inputs, as long as these
+    are added first.
+
+    Example:
+
+    >>> engine = DerivedEngine(default_channels(), prefix="bluefors/")
+    >>> derived_updates = engine.process(parser.updates)
+    """
+
+    def __init__(self, channels=(), prefix=""):
+        self.prefix = prefix
+        self.channels = []
+        self.by_input = collections.defaultdict(list)
+        self.values = {}
+        # time of the last value of the inputs and derived channels
+        self.times = {}
+        for channel in channels:
+            self.add_channel(channel)
+
+    def add_channel(self, channel):
+        id = self.prefix + channel.name
+        if id in self.by_input:
+            raise ValueError(
+                "channel {} is used before it is defined".format(id))
+        index = len(self.channels)
+        self.channels.append(channel)
+        for input in channel.inputs:
+            self.by_input[self.prefix + input].append(index)
+
+    def names(self):
+        return set(c.name for c in self.channels)
+
+    def process(self, updates, now=None, times=None):
+        """Recompute the channels depending on the ids in updates, a dict
+        mapping ids to values. Return a dict of the derived updates.
+
+        The time of each update is taken from times, a dict mapping ids to
+        timestamps, or is now. A derived value gets the time of its most
+        recent input, see self.times.
+        """
+        if now is None:
+            now = time.time()
+        if times is None:
+            times = {}
+        pending = []
+        for id, value in updates.items():
+            indices = self.by_input.get(id)
+            if indices:
+                self.values[id] = logwatcher.field_value(value)
+                self.times[id] = times.get(id, now)
+                pending.extend(indices)
+        heapq.heapify(pending)
+
+        # channels only depend on channels with lower index, so
+        # evaluating in index order computes every channel at most once.
+        results = {}
+        last = -1
+        while pending:
+            index = heapq.heappop(pending)
+            if index == last:
+                continue
+            last = index
+            channel = self.channels[index]
+            inputs = [self.prefix + i for i in channel.inputs]
+            try:
+                values = [self.values[i] for i in inputs]
+            except KeyError:
+                continue
+            t = max(self.times[i] for i in inputs)
+            value = channel.compute(values, t)
+            if value is None:
+                continue
+            id = self.prefix + channel.name
+            results[id] = (channel.pp_name, channel.pp_unit, value)
+            self.times[id] = t
+            dependents = self.by_input.get(id)
+            if dependents:
+                self.values[id] = value
+                for i in dependents:
+                    heapq.heappush(pending, i)
+        return results
+
+
+# sample heater current for htr_range 0 to 8, in A
+_sample_heater_ranges = [
+    0, 31.6e-6, 100e-6, 316e-6, 1e-3, 3.16e-3, 10e-3, 31.6e-3, 100e-3]
+
+
+def _sample_heater_current(htr, htr_range):
+    htr_range = int(htr_range)
+    if not 0 <= htr_range < len(_sample_heater_ranges):
+        return None
+    return htr * _sample_heater_ranges[htr_range]
+
+
+def default_channels():
+    """Derived channels over the _default_*_fields of logwatcher."""
+    return [
+        DerivedChannel("a1_p_htr", ["a1_u", "a1_r_htr"],
+                       lambda u, r: u * u / r,
+                       "Power warm-up heater", "W"),
+        DerivedChannel("a2_p_htr", ["a2_u", "a2_r_htr"],
+                       lambda u, r: u * u / r,
+                       "Power still heater", "W"),
+        DerivedChannel("htr_current", ["htr", "htr_range"],
+                       _sample_heater_current,
+                       "Sample heater current", "A"),
+        DerivedChannel("cpa_pratio", ["cpahp", "cpalp"],
+                       lambda hp, lp: hp / lp,
+                       "Compressor 1 pressure ratio", ""),
+        DerivedChannel("cpa_pratio_2", ["cpahp_2", "cpalp_2"],
+                       lambda hp, lp: hp / lp,
+                       "Compressor 2 pressure ratio", ""),
+        MovingAverage("t6_mc_avg", "t6_mc", 300,
+                      "Temperature MC (5 min average)", "K"),
+        Slope("t1_50k_rate", "t1_50k", 600, 3600,
+              "Cooldown rate 50K Flange", "K/h"),
+        Slope("t2_4k_rate", "t2_4k", 600, 3600,
+              "Cooldown rate 4K Flange", "K/h"),
+        Slope("t5_still_rate", "t5_still", 600, 3600,
+              "Cooldown rate Still", "K/h"),
+        Slope("t6_mc_rate", "t6_mc", 600, 3600,
+              "Cooldown rate MC", "K/h"),
+    ]
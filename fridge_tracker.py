@@ -1,20 +1,21 @@
 import pandas
+import numpy
+import dateutil.tz
 import glob
 from collections import OrderedDict
 from bokeh.plotting import figure, gridplot
 import datetime
+import math
+import os
 import bokeh
 
+import logwatcher
+import rollup
+
 startdate = "17-11-17"
 
 log_folder = "/home/brianzi/delft/tarja_log_html/Logs/"
 
-folders_with_logs = [
-    d for d in glob.glob(
-        log_folder + "*")
-    if d >= log_folder + startdate
-]
-
 temp_names_legends = {
     "CH1": "T 50K Flange",
     "CH2": "T 4K Flange",
@@ -22,6 +23,8 @@ temp_names_legends = {
     "CH6": "T MC"
 }
 
+flow_name = "Flow (mmol/s)"
+
 temp_colors = {
     "T 50K Flange": "red",
     "T 4K Flange": "orange",
@@ -48,94 +51,6 @@ pressure_colors = OrderedDict({
 })
 
 
-flow_dfs = []
-files = [glob.glob(d + "Flow*.log") for d in folders_with_logs]
-for f in files:
-    flow_dfs.append(pandas.read_csv(
-        f, names=["date", "time", "Flow (mmol/s)"], parse_dates=[[0, 1]]))
-df = pandas.concat(flow_dfs)
-df = df.sort_values(by="date_time")
-df = df.set_index("date_time")
-flow_df = df
-
-
-temps_dfs = []
-for channelname, name in temp_names_legends.items():
-    files = [glob.glob(d + "/{} *.log".format(channelname))
-             for d in folders_with_logs]
-    # files = glob.glob("**/*{} T*.log".format(channelname))
-    dfs = []
-    for f in files:
-        dfs.append(pandas.read_csv(
-            f, names=["date", "time", name], parse_dates=[[0, 1]]))
-    df = pandas.concat(dfs)
-    df = df.sort_values(by="date_time")
-    df = df.set_index("date_time")
-    temps_dfs.append(df)
-
-whole_df_temp = pandas.concat(temps_dfs, axis=1)
-whole_df_temp = pandas.concat(
-    (whole_df_temp.iloc[:-200:30], whole_df_temp.iloc[-200:]))
-
-
-# files = glob.glob("**/maxigauge*.log".format(channelname))
-files = [glob.glob(d + "maxigauge*.log") for d in folders_with_logs]
-dfs = []
-for f in files:
-    dfs.append(pandas.read_csv(f, header=None, parse_dates=[[0, 1]]))
-df = pandas.concat(dfs)
-df = df.set_index("0_1")
-df.index.name = "Log Time"
-df = df.sort_index()
-
-whole_df_press = df[list(sorted(pressure_names_cols.values()))]
-whole_df_press.columns = list(pressure_names_cols.keys())
-
-whole_df_press = pandas.concat(
-    (whole_df_press.iloc[:-200:30], whole_df_press.iloc[-200:]))
-
-whole_df_press.index.name = "Log Time"
-whole_df_temp.index.name = "Log Time"
-
-
-# create a new plot with a title and axis labels
-p1 = figure(
-    title="Temperatures",
-    x_axis_label='Time in Delft',
-    y_axis_label='Temperature (K)',
-    x_axis_type="datetime",
-    y_axis_type="log")
-
-# add a line renderer with legend and line thickness
-for n in whole_df_temp:
-    p1.circle(
-        x=whole_df_temp.index,
-        y=whole_df_temp[n],
-        color=temp_colors[n],
-        legend=n)
-
-p2 = figure(
-    title="Pressures",
-    x_axis_label='Time in Delft',
-    y_axis_label='Pressure (mbar)',
-    x_axis_type="datetime",
-    y_axis_type="log",
-    x_range=p1.x_range)
-
-for n in whole_df_press:
-    p2.circle(
-        whole_df_press.index,
-        whole_df_press[n],
-        legend=n,
-        color=pressure_colors[n])
-
-
-p = gridplot([[p1], [p2]])
-script, div = bokeh.embed.components(p)
-
-temp_table = whole_df_temp.iloc[-1:].to_html()
-press_table = whole_df_press.iloc[-1:].to_html()
-
 stylesheet = """
 .dataframe table,th,td {
    border: 0px solid black;
@@ -146,7 +61,7 @@ stylesheet = """
 .dataframe td{text-align: right; min-width:5em;}
 }"""
 
-html = """
+html_template = """
 <html>
 <link
     href="http://cdn.pydata.org/bokeh/release/bokeh-0.12.9.min.css"
@@ -182,14 +97,169 @@ Last update: {date_now}
 {div}
 </body>
 </html>
-""".format(data_script=script,
-           stylesheet=stylesheet,
-           div=div,
-           temp_table=temp_table,
-           flow_table=flow_df[-1:].to_html(),
-           press_table=press_table,
-           date_now=datetime.datetime.now())
-
-
-with open("index.html", "w") as f:
-    f.write(html)
+"""
+
+
+def log_sources():
+    """Return a list of (file pattern, {channel name: column})
+    of the logged channels. The patterns are without extension, so they
+    match compressed log files as well.
+    """
+    sources = [("Flow*", {flow_name: 2})]
+    for channelname, name in temp_names_legends.items():
+        sources.append(("{} *".format(channelname), {name: 2}))
+    sources.append(("maxigauge*", pressure_names_cols))
+    return sources
+
+
+def ingest(store, folders_with_logs):
+    """Add the samples of the log files to the rollups of store,
+    skipping the days which are already in the rollups.
+    """
+    for pattern, columns in log_sources():
+        resume = min(store.resume_time(name) for name in columns)
+        first = ""
+        if resume > -math.inf:
+            first = rollup.from_timestamp(resume).strftime("%y-%m-%d")
+        for d in folders_with_logs:
+            if os.path.basename(d) < first:
+                continue
+            for f in logwatcher.log_files(d, pattern):
+                # compressed files are decompressed by pandas
+                df = pandas.read_csv(
+                    f, header=None, parse_dates=[[0, 1]], dayfirst=True)
+                times = local_timestamps(df["0_1"])
+                for name, col in columns.items():
+                    store.add_series(name, times.values, df[col].values)
+
+
+def local_timestamps(series):
+    """Return the unix times of a Series of naive local datetimes, as
+    rollup.timestamp(). As with datetime.timestamp(), ambiguous times at
+    the end of daylight saving time are taken as the first occurrence;
+    nonexistent ones (not written by a clock in local time) are shifted
+    to the end of the gap.
+    """
+    local = series.dt.tz_localize(
+        dateutil.tz.tzlocal(),
+        ambiguous=numpy.ones(len(series), dtype=bool),
+        nonexistent="shift_forward")
+    return (local - pandas.Timestamp(0, tz="UTC")).dt.total_seconds()
+
+
+def rollup_frame(store, channels, start, end, points):
+    """Return a DataFrame of the means of the channels between start and
+    end, at the coarsest resolution giving at least points points.
+    """
+    columns = OrderedDict()
+    for name in channels:
+        resolution, rows = store.query(name, start, end, points)
+        columns[name] = pandas.Series(
+            [r[3] for r in rows],
+            index=pandas.DatetimeIndex(
+                [rollup.from_timestamp(r[0]) for r in rows]))
+    df = pandas.DataFrame(columns)
+    df.index.name = "Log Time"
+    return df
+
+
+def last_frame(store, channels):
+    """Return a one-row DataFrame of the last values of the channels at
+    the finest resolution, indexed by the time of the most recent one.
+    """
+    columns = OrderedDict()
+    times = []
+    for name in channels:
+        row = store.last(name)
+        columns[name] = [math.nan if row is None else row[3]]
+        if row is not None:
+            times.append(row[0])
+    index = [rollup.from_timestamp(max(times))] if times else [pandas.NaT]
+    df = pandas.DataFrame(columns, index=pandas.DatetimeIndex(index))
+    df.index.name = "Log Time"
+    return df
+
+
+def make_report(log_folder=log_folder, startdate=startdate,
+                output="index.html", points=2000):
+    """Plot the logs in the day folders of log_folder since startdate
+    and write the report to output.
+
+    The plots are made from the rollups kept in the "rollups" folder of
+    log_folder, at the coarsest resolution giving at least points points.
+    """
+    folders_with_logs = sorted(
+        d for d in glob.glob(
+            log_folder + "*")
+        if d >= log_folder + startdate
+    )
+
+    store = rollup.RollupStore(os.path.join(log_folder, "rollups"))
+    ingest(store, folders_with_logs)
+    store.save()
+
+    start = rollup.timestamp(
+        datetime.datetime.strptime(startdate, "%y-%m-%d"))
+    end = rollup.timestamp(datetime.datetime.now())
+
+    whole_df_temp = rollup_frame(
+        store, temp_names_legends.values(), start, end, points)
+    whole_df_press = rollup_frame(
+        store, pressure_names_cols, start, end, points)
+
+    # last values from the finest level
+    last_temp = last_frame(store, temp_names_legends.values())
+    last_press = last_frame(store, pressure_names_cols)
+    last_flow = last_frame(store, [flow_name])
+
+    # create a new plot with a title and axis labels
+    p1 = figure(
+        title="Temperatures",
+        x_axis_label='Time in Delft',
+        y_axis_label='Temperature (K)',
+        x_axis_type="datetime",
+        y_axis_type="log")
+
+    # add a line renderer with legend and line thickness
+    for n in whole_df_temp:
+        p1.circle(
+            x=whole_df_temp.index,
+            y=whole_df_temp[n],
+            color=temp_colors[n],
+            legend=n)
+
+    p2 = figure(
+        title="Pressures",
+        x_axis_label='Time in Delft',
+        y_axis_label='Pressure (mbar)',
+        x_axis_type="datetime",
+        y_axis_type="log",
+        x_range=p1.x_range)
+
+    for n in whole_df_press:
+        p2.circle(
+            whole_df_press.index,
+            whole_df_press[n],
+            legend=n,
+            color=pressure_colors[n])
+
+    p = gridplot([[p1], [p2]])
+    script, div = bokeh.embed.components(p)
+
+    temp_table = last_temp.to_html()
+    press_table = last_press.to_html()
+
+    html = html_template.format(data_script=script,
+                                stylesheet=stylesheet,
+                                div=div,
+                                temp_table=temp_table,
+                                flow_table=last_flow.to_html(),
+                                press_table=press_table,
+                                date_now=datetime.datetime.now())
+
+    with open(output, "w") as f:
+        f.write(html)
+
+
+if __name__ == '__main__':
+    make_report()
@@ -10,13 +10,44 @@ License: MIT
 import os
 import time
 import errno
+import glob
+import gzip
+import lzma
 import stat
 import collections
+import collections.abc
 import datetime
 import json
 import requests
 import re
 
+import metrics
+
+
+# the metrics of the watcher process, kept out of the global registry,
+# which is rendered by the server
+registry = metrics.Registry()
+
+lines_read = metrics.Counter(
+    "fridgemon_watcher_lines_total",
+    "Lines read by the log watcher", ["file"], registry=registry)
+
+process_seconds = metrics.Histogram(
+    "fridgemon_watcher_process_seconds",
+    "Time to process a batch of new lines of a file", registry=registry)
+lines_parsed = metrics.Counter(
+    "fridgemon_parsed_lines_total",
+    "Lines parsed", ["parser"], registry=registry)
+parse_seconds = metrics.Histogram(
+    "fridgemon_parse_seconds",
+    "Time to parse a line (sampled)", ["parser"], registry=registry)
+publish_seconds = metrics.Histogram(
+    "fridgemon_publish_seconds",
+    "Latency of publishing updates to the server", registry=registry)
+
+# date in the names of the daily log files
+_file_date_regex = re.compile(r"[ _]?\d\d-\d\d-\d\d")
+
 
 class LogWatcher(object):
     """Looks for changes in all files of a directory.
@@ -50,12 +81,13 @@ class LogWatcher(object):
             read last N lines from files being watched before starting
         """
         self.files_map = {}
+        self.process_timer = metrics.Timer(process_seconds)
         self.callback = callback
         self.folder = os.path.realpath(folder)
         self.extensions = extensions
         assert os.path.isdir(self.folder), "%s does not exists" \
             % self.folder
-        assert isinstance(callback, collections.Callable)
+        assert isinstance(callback, collections.abc.Callable)
         self.update_files()
         # The first time we run the script we move all file markers at EOF.
         # In case of files created afterwards we don't do this.
@@ -69,15 +101,15 @@ class LogWatcher(object):
     def __del__(self):
         self.close()
 
-    def loop(self, interval=0.1, async=False):
+    def loop(self, interval=0.1, blocking=True):
         """Start the loop.
-        If async is True make one loop then return.
+        If blocking is False make one loop then return.
         """
         while True:
             self.update_files()
             for fid, file in list(self.files_map.items()):
                 self.readfile(file)
-            if async:
+            if not blocking:
                 return
             time.sleep(interval)
 
@@ -90,10 +122,9 @@ class LogWatcher(object):
         You may want to override this to add extra logic or
         globbling support.
         """
-        ls = os.listdir(self.folder)
-        import glob
-
         ls = glob.glob(self.folder + "/**/*")
+        # compressed files are closed archives, never written to
+        ls = [x for x in ls if not x.endswith(compressed_suffixes)]
         if self.extensions:
             return [x for x in ls if os.path.splitext(x)[1][1:]
                     in self.extensions]
@@ -104,32 +135,29 @@ class LogWatcher(object):
     def tail(fname, window):
         """Read last N lines from file fname."""
         try:
-            f = open(fname, 'r')
+            f = open(fname, 'rb')
         except IOError as err:
             if err.errno == errno.ENOENT:
                 return []
             else:
                 raise
         else:
-            BUFSIZ = 1024
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            block = -1
-            data = ""
-            exit = False
-            while not exit:
-                step = (block * BUFSIZ)
-                if abs(step) >= fsize:
-                    f.seek(0)
-                    exit = True
-                else:
-                    f.seek(fsize + step, 0)
-                data = f.read().strip()
-                if data.count('\n') > window:
-                    break
-                else:
-                    block -= 1
-            return data.splitlines()[-window:]
+            BUFSIZ = 64 * 1024
+            with f:
+                pos = f.seek(0, os.SEEK_END)
+                blocks = []
+                newlines = 0
+                # read blocks backwards until we have enough lines;
+                # one extra newline for a trailing one
+                while pos > 0 and newlines <= window:
+                    step = min(BUFSIZ, pos)
+                    pos -= step
+                    f.seek(pos)
+                    block = f.read(step)
+                    blocks.append(block)
+                    newlines += block.count(b'\n')
+            data = b"".join(reversed(blocks)).decode(errors="replace")
+            return data.strip().splitlines()[-window:]
 
     def update_files(self):
         ls = []
@@ -169,7 +197,11 @@ class LogWatcher(object):
     def readfile(self, file):
         lines = file.readlines()
         if lines:
-            self.callback(file.name, lines)
+            # label by the kind of file, not by the daily file
+            kind = _file_date_regex.sub("", os.path.basename(file.name))
+            lines_read.labels(kind).inc(len(lines))
+            with self.process_timer:
+                self.callback(file.name, lines)
 
     def watch(self, fname):
         try:
@@ -239,6 +271,11 @@ class LogLineParserBase:
         self._values = {}
         self.updates = {}
 
+        parser_name = type(self).__name__
+        self.lines_parsed = lines_parsed.labels(parser_name)
+        self.parse_timer = metrics.Timer(
+            parse_seconds.labels(parser_name), sample=100)
+
     def accept_file(self, filename):
         if self.filename_regex.match(filename):
             return True
@@ -246,24 +283,26 @@ class LogLineParserBase:
             return False
 
     def parse_line(self, line):
-        date, time, *items = [i.strip() for i in line.split(",")]
-        dt = datetime.datetime.strptime(
-            date + " " + time, "%d-%m-%y %H:%M:%S")
+        self.lines_parsed.inc()
+        with self.parse_timer:
+            date, time, *items = [i.strip() for i in line.split(",")]
+            dt = datetime.datetime.strptime(
+                date + " " + time, "%d-%m-%y %H:%M:%S")
 
-        self._values['time'] = dt
+            self._values['time'] = dt
 
-        self.parse_items(items)
+            self.parse_items(items)
 
-        # compare last values and new values
+            # compare last values and new values
 
-        self.updates = {}
+            self.updates = {}
 
-        for k in self._values:
-            if (k not in self.last_values or
-                    self._values[k] != self.last_values[k]):
-                self.updates[k] = self._values[k]
+            for k in self._values:
+                if (k not in self.last_values or
+                        self._values[k] != self.last_values[k]):
+                    self.updates[k] = self._values[k]
 
-        self.last_values = self._values.copy()
+            self.last_values = self._values.copy()
 
         return self.updates
 
@@ -405,6 +444,184 @@ _default_status_fields = {
 }
 
 
+# field specs by source, the part of the names of the log files which
+# identifies their kind (as used by the watcher)
+_default_sources = collections.OrderedDict([
+    ("CH1 T", _default_temp_fields_CH1),
+    ("CH2 T", _default_temp_fields_CH2),
+    ("CH5 T", _default_temp_fields_CH5),
+    ("CH6 T", _default_temp_fields_CH6),
+    ("heaters", _default_heater_fields),
+    ("Flowmeter", _default_flowmeter_fields),
+    ("maxigauge", _default_pressure_fields),
+    ("Status", _default_status_fields),
+])
+
+_default_field_specs = list(_default_sources.values())
+
+
+def field_names(field_specs=None):
+    """Return the set of node names defined by the field specs.
+
+    If no specs are given, the _default_*_fields dicts of this module
+    are used.
+    """
+    if field_specs is None:
+        field_specs = _default_field_specs
+    names = set()
+    for fields in field_specs:
+        for k, spec in fields.items():
+            names.add(spec[0] if spec[0] is not None else k)
+    return names
+
+
+def field_source(name, sources=None):
+    """Return the source (e.g. "Status") of the field with node name, or
+    None if it is not logged in any of them.
+
+    If no sources are given, the _default_sources of this module are used.
+    """
+    if sources is None:
+        sources = _default_sources
+    for source, fields in sources.items():
+        if name in field_names([fields]):
+            return source
+    return None
+
+
+def field_value(value):
+    """Extract the bare value from a (pp_name, pp_unit, value) entry,
+    as produced by LogLineParserBase.parse_field.
+    """
+    if isinstance(value, (list, tuple)) and len(value) == 3:
+        return value[2]
+    return value
+
+
+# openers of compressed log files by suffix
+compressed_openers = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+compressed_suffixes = tuple(compressed_openers)
+
+
+def open_log(fname):
+    """Open the log file fname for reading in binary mode, decompressing
+    it if it is compressed.
+    """
+    opener = compressed_openers.get(os.path.splitext(fname)[1], open)
+    return opener(fname, "rb")
+
+
+def log_files(folder, pattern="*"):
+    """List the log files matching pattern (without extension) in folder,
+    including compressed ones. At most one file is listed per log: the
+    uncompressed one if it exists (e.g. while compacting), else the first
+    compressed one in the order of compressed_suffixes.
+    """
+    files = {f: f for f in glob.glob(os.path.join(folder, pattern + ".log"))}
+    for suffix in compressed_suffixes:
+        for f in glob.glob(os.path.join(folder, pattern + ".log" + suffix)):
+            files.setdefault(f[:-len(suffix)], f)
+    return sorted(files.values())
+
+
+def read_lines(fname, block_size=1 << 20):
+    """Yield the lines of file fname, reading (and decompressing) it in
+    large blocks.
+
+    An unterminated last line of an uncompressed file is skipped, as it
+    may still be being written.
+    """
+    live = os.path.splitext(fname)[1] not in compressed_openers
+    with open_log(fname) as f:
+        rest = b""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = rest + block
+            end = data.rfind(b"\n") + 1
+            rest = data[end:]
+            yield from data[:end].decode(errors="replace").splitlines()
+        if rest.strip() and not live:
+            yield rest.decode(errors="replace")
+
+
+def history_files(folder, since):
+    """List the log files in the day folders of folder (named like
+    17-11-18, as written by the Bluefors software) from the date of
+    since until today.
+    """
+    first = since.strftime("%y-%m-%d")
+    files = []
+    for d in sorted(os.listdir(folder)):
+        path = os.path.join(folder, d)
+        if d >= first and os.path.isdir(path):
+            files.extend(log_files(path))
+    return files
+
+
+def read_history(folder, parsers, since=None):
+    """Parse the log files in folder since the datetime since (default:
+    start of today) with the parsers accepting them.
+
+    Return (history, latest), where history maps field ids to lists of
+    [timestamp, value] at each change of the value and latest maps the
+    field ids to their last (pp_name, pp_unit, value). The history of a
+    field logged before since starts with its value at since.
+    """
+    if since is None:
+        since = datetime.datetime.combine(
+            datetime.date.today(), datetime.time())
+    history = collections.defaultdict(list)
+    latest = {}
+    # values at since, as the parsers only report changes
+    initial = {}
+    for fname in history_files(folder, since):
+        accepting_parsers = [p for p in parsers if p.accept_file(fname)]
+        if not accepting_parsers:
+            continue
+        for line in read_lines(fname):
+            if not line.strip():
+                continue
+            for p in accepting_parsers:
+                try:
+                    updates = p.parse_line(line)
+                except (ValueError, IndexError):
+                    # malformed line
+                    continue
+                # 'time' is not in the updates if it did not change
+                dt = p.last_values['time']
+                if dt < since:
+                    initial.update(updates)
+                    continue
+                ts = dt.timestamp()
+                for k, v in updates.items():
+                    if k != 'time':
+                        history[k].append([ts, v[2]])
+                        latest[k] = v
+    initial.pop('time', None)
+    since_ts = since.timestamp()
+    for k, v in initial.items():
+        if not history[k] or history[k][0][0] > since_ts:
+            history[k].insert(0, [since_ts, v[2]])
+        latest.setdefault(k, v)
+    return history, latest
+
+
+def publish_history(history, latest, url="http://localhost:5000/bulk"):
+    """Seed the history and latest values of the server in one request."""
+    message = {
+        'history': history,
+        'latest': [{'id': k, 'value': v, 'timestamp': history[k][-1][0]}
+                   for k, v in latest.items()],
+    }
+    with metrics.Timer(publish_seconds):
+        return requests.post(url, data=json.dumps(message, default=str))
+
+
 class StatusParser(LogLineParserBase):
     def parse_items(self, items):
         while items:
@@ -423,36 +640,81 @@ if __name__ == '__main__':
     # import zlib
     # import base64
     # import time
+    import argparse
+    import signal
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--warm-start", type=float, nargs="?", const=0, metavar="HOURS",
+        help="publish the history of the last HOURS hours "
+        "(default: today) on startup")
+    args = argparser.parse_args()
+
     parsers = [
-        ("CH1 T", FieldsParser("bluefors/", _default_temp_fields_CH1)),
-        ("CH2 T", FieldsParser("bluefors/", _default_temp_fields_CH2)),
-        ("CH5 T", FieldsParser("bluefors/", _default_temp_fields_CH5)),
-        ("CH6 T", FieldsParser("bluefors/", _default_temp_fields_CH6)),
-        ("maxigauge", FieldsParser("bluefors/", _default_pressure_fields)),
-        ("Flowmeter", FieldsParser("bluefors/", _default_flowmeter_fields)),
-        ("heaters", StatusParser("bluefors/", _default_heater_fields)),
-        ("Status", StatusParser("bluefors/", _default_status_fields)),
+        ("CH1 T", FieldsParser(
+            "bluefors/", ".*CH1 T", _default_temp_fields_CH1)),
+        ("CH2 T", FieldsParser(
+            "bluefors/", ".*CH2 T", _default_temp_fields_CH2)),
+        ("CH5 T", FieldsParser(
+            "bluefors/", ".*CH5 T", _default_temp_fields_CH5)),
+        ("CH6 T", FieldsParser(
+            "bluefors/", ".*CH6 T", _default_temp_fields_CH6)),
+        ("maxigauge", FieldsParser(
+            "bluefors/", ".*maxigauge", _default_pressure_fields)),
+        ("Flowmeter", FieldsParser(
+            "bluefors/", ".*Flowmeter", _default_flowmeter_fields)),
+        ("heaters", StatusParser(
+            "bluefors/", ".*heaters", _default_heater_fields)),
+        ("Status", StatusParser(
+            "bluefors/", ".*Status", _default_status_fields)),
     ]
 
     def callback(filename, lines):
+        # publish the updates of every new line, with the time of the line
+        update_message = []
         for n, p in parsers:
             if n in filename:
                 for l in lines:
-                    p.parse_line(l)
+                    try:
+                        updates = p.parse_line(l)
+                    except (ValueError, IndexError):
+                        # malformed or partly written line
+                        continue
                     p.pretty_print_status()
-
-        # publish the update
-        all_updates = {}
-        for n, p in parsers:
-            all_updates.update(p.updates)
-
-        update_message = [{'id': k, 'value': v} for k, v in all_updates.items()]
-
-        r = requests.post(
-            "http://localhost:5000/update",
-            data=json.dumps(update_message, default=str))
+                    timestamp = p.last_values['time'].timestamp()
+                    # the source tells the server a line arrived, even
+                    # if it changes no value
+                    update_message.extend(
+                        {'id': k, 'value': v, 'timestamp': timestamp,
+                         'source': n}
+                        for k, v in updates.items())
+
+        if not update_message:
+            return
+
+        with publish_timer:
+            r = requests.post(
+                "http://localhost:5000/update",
+                data=json.dumps(update_message, default=str))
         print(r.status_code)
         print(r.json())
 
-    lw = LogWatcher("./Logs/", callback, tail_lines=1)
+    publish_timer = metrics.Timer(publish_seconds)
+
+    # kill -USR1 dumps the metrics of the watcher
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: registry.dump())
+
+    lw = LogWatcher("./Logs/", callback,
+                    tail_lines=0 if args.warm_start is not None else 1)
+    if args.warm_start is not None:
+        # after the watcher is set up, so no lines are missed in between
+        since = None
+        if args.warm_start:
+            since = (datetime.datetime.now() -
+                     datetime.timedelta(hours=args.warm_start))
+        history, latest = read_history(
+            "./Logs/", [p for n, p in parsers], since)
+        r = publish_history(history, latest)
+        print(r.status_code)
     lw.loop()
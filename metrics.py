@@ -0,0 +1,218 @@
+"""
+Low-overhead metrics for the monitoring pipeline.
+
+Counters, gauges and histograms keep their values in preallocated
+structures; histograms have fixed buckets. Timers only measure every
+N-th call, so they can be left on in production. All metrics register
+themselves in a registry, which renders them in the Prometheus text
+format.
+
+Usage as a script dumps the metrics of a running server:
+
+    python metrics.py [http://localhost:5000/metrics]
+"""
+
+import bisect
+import sys
+import time
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for m in self.metrics:
+            lines.append("# HELP {} {}".format(m.name, m.help))
+            lines.append("# TYPE {} {}".format(m.name, m.type))
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file=None):
+        (file or sys.stdout).write(self.render())
+
+
+registry = Registry()
+
+
+def _labelstr(names, values, extra=""):
+    items = ['{}="{}"'.format(n, str(v).replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(items) + "}"
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+        if registry is not None:
+            registry.register(self)
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return the child metric for the label values. Keep the result
+        around in hot code paths.
+        """
+        try:
+            return self.children[values]
+        except KeyError:
+            child = self.children[values] = self._child()
+            return child
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            yield "{}{} {}".format(
+                self.name, _labelstr(self.labelnames, values), child.value)
+
+
+class _Value(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    type = "counter"
+    _child = _Value
+
+    def inc(self, amount=1):
+        self.children[()].value += amount
+
+
+class Gauge(Metric):
+    """A gauge, either set explicitly or computed by func when rendered.
+    func returns a number, or for labelled gauges a dict mapping tuples of
+    label values to numbers.
+    """
+    type = "gauge"
+    _child = _Value
+
+    def __init__(self, name, help, labelnames=(), func=None,
+                 registry=registry):
+        self.func = func
+        super().__init__(name, help, labelnames, registry)
+
+    def set(self, value):
+        self.children[()].value = value
+
+    def samples(self):
+        if self.func is not None:
+            values = self.func()
+            if not self.labelnames:
+                values = {(): values}
+            self.children = {}
+            for k, v in values.items():
+                self.labels(*k).set(v)
+        return super().samples()
+
+
+# 10 us to 10 s
+default_buckets = (
+    1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1, 3, 10)
+
+
+class _HistogramValue(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets,
+                 registry=registry):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames, registry)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            cumulative = 0
+            for le, n in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += n
+                yield "{}_bucket{} {}".format(
+                    self.name,
+                    _labelstr(self.labelnames, values, 'le="{}"'.format(le)),
+                    cumulative)
+            labels = _labelstr(self.labelnames, values)
+            yield "{}_sum{} {}".format(self.name, labels, child.sum)
+            yield "{}_count{} {}".format(self.name, labels, child.count)
+
+
+class Timer(object):
+    """Context manager timing every `sample`-th execution of a block into
+    a histogram (or a child of one). Not reentrant; use one timer per
+    code path.
+
+    Example:
+
+    >>> parse_timer = Timer(parse_seconds.labels("StatusParser"), 10)
+    >>> with parse_timer:
+    ...     parse(line)
+    """
+
+    def __init__(self, histogram, sample=1):
+        self.histogram = histogram
+        self.sample = sample
+        self.calls = 0
+        self.start = None
+
+    def __enter__(self):
+        self.calls += 1
+        if self.calls >= self.sample:
+            self.calls = 0
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start)
+            self.start = None
+
+
+if __name__ == '__main__':
+    import requests
+
+    url = "http://localhost:5000/metrics"
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    print(requests.get(url).text)
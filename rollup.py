@@ -0,0 +1,215 @@
+"""
+Multi-resolution rollups of the logged channels, for plotting long ranges.
+
+For every channel, min/max/mean/count aggregates are kept at several
+resolutions (by default 10 s, 1 min, 10 min and 1 h). Samples are added
+one by one as they are parsed; every sample updates the open bucket of each
+level, and closed buckets are appended to CSV files on save().
+
+The files are partitioned in time, so that a range query only reads the
+partitions it overlaps:
+
+    <folder>/<resolution>/<channel>/<partition start>.csv
+
+with lines "time,min,max,mean,count". Times are unix times of the naive
+local log times, as datetime.timestamp() and as used by the server, see
+timestamp().
+
+Range queries pick the coarsest level which still gives the requested
+number of points, so the cost of a query does not grow with its range.
+"""
+
+import csv
+import datetime
+import math
+import os
+import urllib.parse
+
+
+default_resolutions = (10, 60, 600, 3600)
+
+# buckets per partition file
+partition_buckets = 8640
+
+def timestamp(dt):
+    """Unix time of the naive local datetime dt."""
+    return dt.timestamp()
+
+
+def from_timestamp(t):
+    """Inverse of timestamp(), as a naive local datetime."""
+    return datetime.datetime.fromtimestamp(t)
+
+
+class Level(object):
+    """The aggregates of one channel at one resolution (in seconds)."""
+
+    def __init__(self, resolution, folder=None):
+        self.resolution = resolution
+        self.folder = folder
+        self.span = resolution * partition_buckets
+        # closed but unsaved buckets as [time, min, max, sum, count]
+        self.rows = []
+        self.bucket = None
+        self.saved_until = -math.inf
+        if folder is not None and os.path.isdir(folder):
+            partitions = self.partitions()
+            if partitions:
+                last = self.read_partition(partitions[-1])
+                if last:
+                    self.saved_until = last[-1][0] + resolution
+
+    def add(self, t, value):
+        if t < self.saved_until:
+            return
+        start = t - t % self.resolution
+        b = self.bucket
+        if b is not None and start == b[0]:
+            if value < b[1]:
+                b[1] = value
+            if value > b[2]:
+                b[2] = value
+            b[3] += value
+            b[4] += 1
+        elif b is None or start > b[0]:
+            if b is not None:
+                self.rows.append(b)
+            self.bucket = [start, value, value, value, 1]
+        # samples older than the open bucket are dropped
+
+    def partitions(self):
+        """Return the sorted start times of the partition files."""
+        return sorted(int(f[:-4]) for f in os.listdir(self.folder)
+                      if f.endswith(".csv"))
+
+    def read_partition(self, partition):
+        fname = os.path.join(self.folder, "{}.csv".format(partition))
+        with open(fname, newline="") as f:
+            return [(float(t), float(lo), float(hi), float(mean), int(n))
+                    for t, lo, hi, mean, n in csv.reader(f)]
+
+    def save(self):
+        """Append the closed buckets to the partition files."""
+        if self.folder is None or not self.rows:
+            return
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        by_partition = {}
+        for t, lo, hi, s, n in self.rows:
+            partition = int(t - t % self.span)
+            by_partition.setdefault(partition, []).append(
+                (t, lo, hi, s / n, n))
+        for partition, rows in sorted(by_partition.items()):
+            fname = os.path.join(self.folder, "{}.csv".format(partition))
+            with open(fname, "a", newline="") as f:
+                csv.writer(f).writerows(rows)
+        self.saved_until = self.rows[-1][0] + self.resolution
+        self.rows = []
+
+    def query(self, start, end):
+        """Return the buckets in [start, end) as a list of
+        (time, min, max, mean, count), including the open bucket.
+        """
+        rows = []
+        if self.folder is not None and os.path.isdir(self.folder):
+            first = start - start % self.span
+            for partition in self.partitions():
+                if first <= partition < end:
+                    rows.extend(self.read_partition(partition))
+        unsaved = self.rows + ([self.bucket] if self.bucket else [])
+        rows.extend((t, lo, hi, s / n, n) for t, lo, hi, s, n in unsaved)
+        return [r for r in rows if start <= r[0] < end]
+
+    def last(self):
+        """Return the most recent bucket as (time, min, max, mean, count),
+        or None if there is none.
+        """
+        b = self.bucket or (self.rows[-1] if self.rows else None)
+        if b is not None:
+            t, lo, hi, s, n = b
+            return (t, lo, hi, s / n, n)
+        if self.folder is not None and os.path.isdir(self.folder):
+            for partition in reversed(self.partitions()):
+                rows = self.read_partition(partition)
+                if rows:
+                    return rows[-1]
+        return None
+
+
+class RollupStore(object):
+    """Rollups of many channels, persisted in folder (or only kept in
+    memory if folder is None).
+
+    Example:
+
+    >>> store = RollupStore("Logs/rollups")
+    >>> store.add("bluefors/t6_mc", timestamp(dt), value)
+    >>> store.save()
+    >>> resolution, rows = store.query("bluefors/t6_mc", start, end, 1000)
+    """
+
+    def __init__(self, folder=None, resolutions=default_resolutions):
+        self.folder = folder
+        self.resolutions = sorted(resolutions)
+        self.channels = {}
+
+    def levels(self, channel):
+        try:
+            return self.channels[channel]
+        except KeyError:
+            levels = self.channels[channel] = [
+                Level(r, self._folder(channel, r)) for r in self.resolutions]
+            return levels
+
+    def _folder(self, channel, resolution):
+        if self.folder is None:
+            return None
+        return os.path.join(self.folder, str(resolution),
+                            urllib.parse.quote(channel, safe=""))
+
+    def add(self, channel, t, value):
+        for level in self.levels(channel):
+            level.add(t, value)
+
+    def add_series(self, channel, times, values):
+        levels = self.levels(channel)
+        for t, value in zip(times, values):
+            if value != value:
+                # NaN
+                continue
+            for level in levels:
+                level.add(t, value)
+
+    def resume_time(self, channel):
+        """Return the time from which samples of channel have to be added
+        again after loading, to complete the open buckets.
+        """
+        return min(level.saved_until for level in self.levels(channel))
+
+    def save(self):
+        for levels in self.channels.values():
+            for level in levels:
+                level.save()
+
+    def pick_resolution(self, start, end, points):
+        """Return the coarsest resolution giving at least points buckets
+        in [start, end), or the finest one.
+        """
+        for r in reversed(self.resolutions):
+            if (end - start) / r >= points:
+                return r
+        return self.resolutions[0]
+
+    def query(self, channel, start, end, points):
+        """Return (resolution, rows) for channel in [start, end) with at
+        least points rows if possible; see Level.query.
+        """
+        r = self.pick_resolution(start, end, points)
+        level = self.levels(channel)[self.resolutions.index(r)]
+        return r, level.query(start, end)
+
+    def last(self, channel):
+        """Return the most recent bucket of channel at the finest
+        resolution, whatever its age; see Level.last.
+        """
+        return self.levels(channel)[0].last()
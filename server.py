@@ -2,22 +2,32 @@
 #
 # Make sure your gevent version is >= 1.0
 import gevent
-from gevent.wsgi import WSGIServer
+from gevent.pywsgi import WSGIServer
 from gevent.queue import Queue
 
 from flask import Flask, Response, request
 
 import flask
 
+import collections
+import heapq
+import itertools
 import json
+import os
+import time
+
+import alerts
+import derived
+import logwatcher
+import metrics
 
 
 # SSE "protocol" is described here: http://mzl.la/UPFyxY
 class ServerSentEvent(object):
 
-    def __init__(self, data):
+    def __init__(self, data, event=None):
         self.data = data
-        self.event = None
+        self.event = event
         self.id = None
         self.desc_map = {
             self.data: "data",
@@ -37,9 +47,45 @@ class ServerSentEvent(object):
 app = Flask(__name__)
 subscriptions = []
 
+# prefix of the field ids, as used by the publishing parsers
+field_prefix = "bluefors/"
+
+derived_engine = derived.DerivedEngine(
+    derived.default_channels(), prefix=field_prefix)
+
+alert_rules_file = "alert_rules.json"
+alert_engine = alerts.AlertEngine(hooks=[alerts.print_hook])
+
 
 datadict = {}
 
+# recent values of each field as [timestamp, value]
+history_length = 20000
+history = collections.defaultdict(
+    lambda: collections.deque(maxlen=history_length))
+
+update_seconds = metrics.Histogram(
+    "fridgemon_server_update_seconds",
+    "Time to handle an update request")
+notify_seconds = metrics.Histogram(
+    "fridgemon_server_notify_seconds",
+    "Time to queue a message for all subscribers")
+line_latency_seconds = metrics.Histogram(
+    "fridgemon_line_to_sse_seconds",
+    "Time from the timestamp of the oldest log line of an update "
+    "to queueing it for the subscribers (1 s resolution)",
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 300))
+metrics.Gauge(
+    "fridgemon_subscribers", "Number of subscribers",
+    func=lambda: len(subscriptions))
+metrics.Gauge(
+    "fridgemon_subscriber_queue_depth",
+    "Messages waiting in the queue of each subscriber", ["subscriber"],
+    func=lambda: {(n,): q.qsize() for n, q in enumerate(subscriptions)})
+
+update_timer = metrics.Timer(update_seconds)
+notify_timer = metrics.Timer(notify_seconds)
+
 # Client code consumes like this.
 
 
@@ -66,21 +112,126 @@ def debug():
     return html
 
 
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.registry.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/alerts")
+def active_alerts():
+    return json.dumps(alert_engine.active_alerts())
+
+
+def publish(data, event=None):
+    """Send data to all subscribers, encoding the event only once."""
+    with notify_timer:
+        msg = ServerSentEvent(data, event).encode()
+        for sub in subscriptions[:]:
+            sub.put(msg)
+
+
+def publish_updates(data, line_time=None):
+    publish(data)
+    if line_time is not None:
+        line_latency_seconds.observe(time.time() - line_time)
+
+
+def publish_alert(alert):
+    gevent.spawn(publish, json.dumps(alert, default=str), "alert")
+
+
+alert_engine.hooks.append(publish_alert)
+
+
+def check_stale_alerts(interval=1):
+    while True:
+        alert_engine.check_stale()
+        gevent.sleep(interval)
+
+
 @app.route('/update', methods=['POST'])
 def update(*args, **kwargs):
+    with update_timer:
+        j = json.loads(request.data)
+        timestamps = [i['timestamp'] for i in j if 'timestamp' in i]
+        now = time.time()
+        # the watcher sends the updates of each log line in turn, all with
+        # the time of the line; process them line by line, so that windowed
+        # channels and alerts see every sample
+        derived_items = []
+        for t, group in itertools.groupby(
+                j, key=lambda i: i.get('timestamp', now)):
+            group = list(group)
+            updates = {i['id']: i['value'] for i in group}
+            sources = set(i['source'] for i in group if 'source' in i)
+            times = dict.fromkeys(updates, t)
+            for k, v in derived_engine.process(updates, t).items():
+                times[k] = derived_engine.times[k]
+                derived_items.append(
+                    {'id': k, 'value': v, 'timestamp': times[k]})
+                updates[k] = v
+            alert_engine.process(updates, t, times, sources)
+        j.extend(derived_items)
+        for i in j:
+            datadict[i['id']] = i
+            history[i['id']].append(
+                [i.get('timestamp', now), logwatcher.field_value(i['value'])])
+
+        gevent.spawn(publish_updates, json.dumps(j),
+                     min(timestamps, default=None))
+    return json.dumps(dict(result="ok"))
+
+
+def replay_derived(field_history):
+    """Run the history of the fields, a dict mapping ids to lists of
+    [timestamp, value] in time order, through derived_engine.
+
+    Return (history, latest) of the derived channels, in the form of the
+    history and of the updates of /update.
+    """
+    derived_history = collections.defaultdict(list)
+    derived_latest = {}
+    inputs = [[[t, k, v] for t, v in points]
+              for k, points in field_history.items()
+              if k in derived_engine.by_input]
+    samples = heapq.merge(*inputs, key=lambda s: s[0])
+    for t, group in itertools.groupby(samples, key=lambda s: s[0]):
+        updates = {k: v for _, k, v in group}
+        for k, v in derived_engine.process(updates, t).items():
+            ts = derived_engine.times[k]
+            derived_history[k].append([ts, logwatcher.field_value(v)])
+            derived_latest[k] = {'id': k, 'value': v, 'timestamp': ts}
+    return derived_history, list(derived_latest.values())
+
+
+@app.route('/bulk', methods=['POST'])
+def bulk():
+    """Seed the history and the latest values in one request, e.g. when
+    the log watcher starts. Expects a dict with entries "history", mapping
+    ids to lists of [timestamp, value], and "latest", a list of updates.
+
+    The history is replayed through the derived channels, so that their
+    history, latest values and windowed state are seeded as well.
+    """
     j = json.loads(request.data)
-    for i in j:
+    derived_history, derived_latest = replay_derived(j['history'])
+    for k, points in itertools.chain(j['history'].items(),
+                                     derived_history.items()):
+        history[k].extend(points)
+    latest = j['latest'] + derived_latest
+    for i in latest:
         datadict[i['id']] = i
-    print(datadict)
 
-    def notify():
-        msg = json.dumps(j)
-        for sub in subscriptions[:]:
-            sub.put(msg)
-    gevent.spawn(notify)
+    gevent.spawn(publish, json.dumps(latest))
     return json.dumps(dict(result="ok"))
 
 
+@app.route('/history/<path:id>')
+def get_history(id):
+    return json.dumps(list(history.get(id, ())))
+
+
 @app.route("/subscribe")
 def subscribe():
     def gen():
@@ -88,9 +239,7 @@ def subscribe():
         subscriptions.append(q)
         try:
             while True:
-                result = q.get()
-                ev = ServerSentEvent(str(result))
-                yield ev.encode()
+                yield q.get()
         except GeneratorExit:  # Or maybe use flask signals
             subscriptions.remove(q)
 
@@ -99,6 +248,12 @@ def subscribe():
 
 if __name__ == "__main__":
     app.debug = True
+    if os.path.exists(alert_rules_file):
+        alert_engine = alerts.engine_from_file(
+            alert_rules_file, hooks=alert_engine.hooks,
+            known_fields=logwatcher.field_names() | derived_engine.names())
+        print("loaded %d alert rules" % len(alert_engine.rules))
+    gevent.spawn(check_stale_alerts)
     server = WSGIServer(("", 5000), app)
     server.serve_forever()
     # Then visit http://localhost:5000 to subscribe
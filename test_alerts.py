@@ -0,0 +1,112 @@
+import pytest
+
+import alerts
+import logwatcher
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def states(alert_list):
+    return [(a["rule"], a["state"]) for a in alert_list]
+
+
+def test_threshold_hysteresis():
+    engine = alerts.AlertEngine([alerts.ThresholdRule(
+        "P1 high", "p1", above=1e-3, hysteresis=2e-4)], prefix="bluefors/")
+    assert engine.process({"bluefors/p1": 5e-4}) == []
+    assert states(engine.process({"bluefors/p1": 1.1e-3})) == [
+        ("P1 high", "raised")]
+    # back below the threshold, but within the hysteresis
+    assert engine.process({"bluefors/p1": 9e-4}) == []
+    assert states(engine.process({"bluefors/p1": 7e-4})) == [
+        ("P1 high", "cleared")]
+
+
+def test_only_rules_of_updated_ids_are_evaluated():
+    rule = alerts.ThresholdRule("err", "cpaerr", above=0)
+    engine = alerts.AlertEngine([rule])
+    engine.process({"p1": 1})
+    assert not rule.active
+    assert states(engine.process({"cpaerr": ("Compressor 1 Error", None, 3)})
+                  ) == [("err", "raised")]
+
+
+def test_rate_rule_uses_time_of_update():
+    engine = alerts.AlertEngine([alerts.RateRule(
+        "MC warming", "t6_mc", window=600, max_rate=1e-3)])
+    engine.process({"t6_mc": 0.01}, times={"t6_mc": 1000})
+    raised = engine.process({"t6_mc": 0.5}, now=5000, times={"t6_mc": 1100})
+    assert states(raised) == [("MC warming", "raised")]
+    assert raised[0]["time"] == 1100
+    # a resent value with an old time is ignored
+    assert engine.process({"t6_mc": 0.5}, times={"t6_mc": 1100}) == []
+
+
+def test_stale_rule_is_reset_by_any_line_of_its_source():
+    clock = Clock()
+    engine = alerts.AlertEngine([alerts.StaleRule(
+        "compressor stale", "cpaerr", timeout=300)], clock=clock)
+    assert logwatcher.field_source("cpaerr") == "Status"
+    engine.process({"cpaerr": 0}, sources=["Status"])
+    for n in range(10):
+        clock.now += 60
+        # lines which do not change cpaerr
+        engine.process({"cpatempwi": 20 + n}, sources=["Status"])
+        assert engine.check_stale() == []
+    # lines of other files do not count
+    clock.now += 200
+    engine.process({"p1": 1e-3}, sources=["maxigauge"])
+    clock.now += 200
+    assert states(engine.check_stale()) == [("compressor stale", "raised")]
+    assert engine.check_stale() == []
+    assert states(engine.process({}, sources=["Status"])) == [
+        ("compressor stale", "cleared")]
+
+
+def test_stale_rule_without_source_needs_updates():
+    clock = Clock()
+    engine = alerts.AlertEngine([alerts.StaleRule(
+        "average stale", "t6_mc_avg", timeout=300)], clock=clock)
+    clock.now = 200
+    engine.process({"t6_mc_avg": 0.01})
+    clock.now = 400
+    engine.process({}, sources=["CH6 T"])
+    assert engine.check_stale() == []
+    clock.now = 500
+    assert states(engine.check_stale()) == [("average stale", "raised")]
+
+
+def test_stale_rule_ignores_log_times():
+    clock = Clock()
+    clock.now = 1000
+    engine = alerts.AlertEngine([alerts.StaleRule(
+        "MC stale", "t6_mc", timeout=300)], clock=clock)
+    # the log time lags behind the clock of the engine
+    engine.process({"t6_mc": 0.01}, now=500, sources=["CH6 T"])
+    clock.now = 1200
+    assert engine.check_stale() == []
+    clock.now = 1300
+    assert states(engine.check_stale()) == [("MC stale", "raised")]
+
+
+@pytest.mark.parametrize("entry", [
+    {"name": "x", "type": "unknown", "field": "p1"},
+    {"name": "x", "type": "threshold", "field": "nonexistent", "above": 1},
+    {"name": "x", "type": "threshold", "field": "p1"},
+    {"name": "x", "type": "stale", "field": "p1", "timout": 300},
+])
+def test_load_rules_raises_value_error(entry):
+    with pytest.raises(ValueError):
+        alerts.load_rules([entry])
+
+
+def test_duplicate_rule_names():
+    with pytest.raises(ValueError):
+        alerts.AlertEngine([alerts.ThresholdRule("x", "p1", above=1),
+                            alerts.ThresholdRule("x", "p2", above=1)])
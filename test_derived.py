@@ -0,0 +1,76 @@
+import pytest
+
+import derived
+
+
+def test_sample_heater_current():
+    assert derived._sample_heater_current(0.5, 4) == pytest.approx(0.5e-3)
+    assert derived._sample_heater_current(0.5, 0) == 0
+
+
+@pytest.mark.parametrize("htr_range", [9, 100, -1])
+def test_sample_heater_current_out_of_range(htr_range):
+    assert derived._sample_heater_current(0.5, htr_range) is None
+
+    engine = derived.DerivedEngine(derived.default_channels())
+    assert "htr_current" not in engine.process(
+        {"htr": ("", "", 0.5), "htr_range": ("", "", htr_range)}, 0)
+
+
+def test_slope_of_line():
+    slope = derived.Slope("rate", "t", tau=600, per=3600)
+    rates = [slope.compute([300 - 0.01 * t], t) for t in range(0, 3000, 10)]
+    assert rates[0] is None
+    assert rates[-1] == pytest.approx(-36)
+
+
+def test_slope_ignores_old_samples():
+    slope = derived.Slope("rate", "t", tau=600, per=3600)
+    for t in range(0, 600, 10):
+        slope.compute([300 - 0.01 * t], t)
+    # a resent value with an old time is not a new sample
+    assert slope.compute([1000], 300) is None
+    assert slope.compute([300 - 0.01 * 600], 600) == pytest.approx(-36)
+
+
+def test_moving_average():
+    avg = derived.MovingAverage("avg", "t", tau=100)
+    assert avg.compute([1], 0) == 1
+    assert avg.compute([1], 0) is None
+    assert avg.compute([1], 50) == pytest.approx(1)
+    value = avg.compute([0], 150)
+    assert value == pytest.approx(2.718281828 ** -1)
+
+
+def test_engine_evaluates_dependent_channels_in_order():
+    engine = derived.DerivedEngine([
+        derived.DerivedChannel("sum", ["a", "b"], lambda a, b: a + b),
+        derived.DerivedChannel("double", ["sum"], lambda s: 2 * s),
+    ], prefix="p/")
+    assert engine.process({"p/a": 1}, 0) == {}
+    results = engine.process({"p/b": ("B", "", 2)}, 0)
+    assert results == {"p/sum": ("sum", "", 3), "p/double": ("double", "", 6)}
+
+
+def test_engine_rejects_channel_used_before_definition():
+    engine = derived.DerivedEngine(
+        [derived.DerivedChannel("double", ["sum"], lambda s: 2 * s)])
+    with pytest.raises(ValueError):
+        engine.add_channel(
+            derived.DerivedChannel("sum", ["a", "b"], lambda a, b: a + b))
+
+
+def test_engine_uses_time_of_each_input():
+    engine = derived.DerivedEngine([
+        derived.DerivedChannel("ratio", ["hp", "lp"], lambda h, l: h / l),
+        derived.MovingAverage("avg", "t", tau=600),
+    ])
+    engine.process({"hp": 10, "lp": 2, "t": 1}, now=100,
+                   times={"hp": 90, "lp": 80, "t": 70})
+    assert engine.times["ratio"] == 90
+    assert engine.times["avg"] == 70
+
+    # t is not updated, so the average does not get a new sample
+    results = engine.process({"hp": 12}, now=200, times={"hp": 200})
+    assert set(results) == {"ratio"}
+    assert engine.times["ratio"] == 200
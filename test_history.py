@@ -0,0 +1,72 @@
+import datetime
+import os
+
+import benchmark
+import compact_logs
+import logwatcher
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_log_files_lists_one_file_per_log(tmp_path):
+    folder = str(tmp_path)
+    for name in ["a.log", "b.log", "c.log", "d.log", "other.txt"]:
+        write(os.path.join(folder, name), "")
+    compact_logs.compress_file(os.path.join(folder, "b.log"), ".gz")
+    compact_logs.compress_file(os.path.join(folder, "c.log"), ".gz")
+    compact_logs.compress_file(os.path.join(folder, "d.log"), ".xz")
+    # both compressed, and compressed while the original still exists
+    write(os.path.join(folder, "c.log"), "")
+    compact_logs.compress_file(os.path.join(folder, "c.log"), ".xz")
+    write(os.path.join(folder, "a.log.gz"), "")
+
+    names = [os.path.basename(f) for f in logwatcher.log_files(folder)]
+    assert names == ["a.log", "b.log.gz", "c.log.gz", "d.log.xz"]
+    names = [os.path.basename(f) for f in logwatcher.log_files(folder, "c*")]
+    assert names == ["c.log.gz"]
+
+
+def test_read_lines_skips_unterminated_line_of_live_file(tmp_path):
+    fname = str(tmp_path / "a.log")
+    write(fname, "1\n2\n3")
+    assert list(logwatcher.read_lines(fname, block_size=3)) == ["1", "2"]
+    compact_logs.compress_file(fname, ".gz")
+    assert list(logwatcher.read_lines(fname + ".gz")) == ["1", "2", "3"]
+
+
+def test_read_history(tmp_path):
+    folder = str(tmp_path)
+    start = datetime.datetime(2017, 11, 18, 23, 50)
+    benchmark.LogGenerator(folder, start, interval=60).write(20)
+    parsers = list(benchmark.default_parsers().values())
+
+    history, latest = logwatcher.read_history(
+        folder, parsers, start + datetime.timedelta(minutes=5))
+    mc = history["bluefors/t6_mc"]
+    assert len(mc) == 15
+    assert mc[0][0] == (start + datetime.timedelta(minutes=5)).timestamp()
+    assert latest["bluefors/t6_mc"][2] == mc[-1][1]
+    # constant values are only reported once
+    assert len(history["bluefors/cpaerr"]) == 1
+
+
+def test_read_history_skips_partial_and_malformed_lines(tmp_path):
+    day = tmp_path / "17-11-18"
+    day.mkdir()
+    write(str(day / "CH6 T 17-11-18.log"),
+          "18-11-17,10:00:00,1.0E-02\n"
+          "garbage\n"
+          "18-11-17,10:01:00,1.0E-02\n"
+          "18-11-17,10:02:00,2.0E-02\n"
+          "18-11-17,10:03")
+    write(str(day / "maxigauge 17-11-18.log"),
+          "18-11-17,10:00:00,CH1,P1,1\n")
+    parsers = list(benchmark.default_parsers().values())
+
+    history, latest = logwatcher.read_history(
+        str(tmp_path), parsers, datetime.datetime(2017, 11, 18))
+    assert [v for t, v in history["bluefors/t6_mc"]] == [1e-2, 2e-2]
+    assert "bluefors/p1" not in history
@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+import rollup
+
+
+def test_timestamp_is_local_unix_time():
+    dt = datetime.datetime(2017, 11, 18, 12, 30)
+    assert rollup.timestamp(dt) == dt.timestamp()
+    assert rollup.from_timestamp(rollup.timestamp(dt)) == dt
+
+
+def test_level_aggregates():
+    level = rollup.Level(10)
+    for t, value in [(0, 1.0), (5, 3.0), (12, 2.0), (3, 100.0)]:
+        level.add(t, value)
+    # the sample older than the open bucket is dropped
+    assert level.query(0, 100) == [(0, 1.0, 3.0, 2.0, 2), (10, 2.0, 2.0, 2.0, 1)]
+
+
+def test_level_save_and_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(rollup, "partition_buckets", 10)
+    folder = str(tmp_path / "level")
+    level = rollup.Level(10, folder)
+    for t in range(0, 250, 5):
+        level.add(t, float(t))
+    level.save()
+    # two partitions of 100 s and the closed buckets of the third
+    assert level.partitions() == [0, 100, 200]
+    assert level.last() == (240, 240.0, 245.0, 242.5, 2)
+
+    resumed = rollup.Level(10, folder)
+    assert resumed.saved_until == 240
+    assert resumed.last() == (230, 230.0, 235.0, 232.5, 2)
+    # samples already saved are not added again
+    resumed.add(100, -1.0)
+    for t in range(240, 260, 5):
+        resumed.add(t, float(t))
+    rows = resumed.query(90, 260)
+    assert [r[0] for r in rows] == list(range(90, 260, 10))
+    assert rows[1] == (100, 100.0, 105.0, 102.5, 2)
+
+
+def test_store_picks_coarsest_resolution_with_enough_points():
+    store = rollup.RollupStore()
+    assert store.pick_resolution(0, 86400, 100) == 600
+    assert store.pick_resolution(0, 86400, 10) == 3600
+    assert store.pick_resolution(0, 600, 1000) == 10
+
+
+def test_store_resume_time(tmp_path):
+    store = rollup.RollupStore(str(tmp_path))
+    for t in range(0, 7200, 10):
+        store.add("bluefors/t6_mc", t, 1.0)
+    store.save()
+    resumed = rollup.RollupStore(str(tmp_path))
+    # the open buckets are not saved, the 1 h one starts at 3600
+    assert resumed.resume_time("bluefors/t6_mc") == 3600
+    assert resumed.last("bluefors/t6_mc")[0] == 7180
+    assert resumed.last("bluefors/other") is None
+
+
+def test_store_query():
+    store = rollup.RollupStore()
+    store.add_series("a", [0, 10, 20, 30], [1.0, float("nan"), 3.0, 4.0])
+    resolution, rows = store.query("a", 0, 40, 4)
+    assert resolution == 10
+    assert [r[3] for r in rows] == [1.0, 3.0, 4.0]
+    resolution, rows = store.query("a", 0, 3600, 1)
+    assert resolution == 3600
+    assert rows == [(0, 1.0, 4.0, pytest.approx(8 / 3), 3)]